@@ -1,10 +1,11 @@
 """Extract cashflows from transactions.
 
 """
+import bisect
+import collections
 import datetime
 import functools
 import logging
-import operator
 import re
 import dataclasses
 
@@ -13,67 +14,123 @@ from decimal import Decimal
 from typing import List, Optional, Set
 
 import beancount
-from beancount.core.data import Account, Currency, Transaction
+import beancount.core.convert
+import beancount.core.position
+import beancount.core.prices
+from beancount.core.amount import Amount
+from beancount.core.data import Account, Currency, Posting, Transaction
 
-def add_position(p, inventory):
-    if isinstance(p, beancount.core.data.Posting):
-        inventory.add_position(p)
-    elif isinstance(p, beancount.core.data.TxnPosting):
-        inventory.add_position(p.posting)
-    else:
-        raise Exception("Not a Posting or TxnPosting", p)
-
-def is_interesting_posting(posting, interesting_accounts):
-    """ Is this posting for an account we care about? """
-    for pattern in interesting_accounts:
-        if re.match(pattern, posting.account):
-            return True
-    return False
-
-def is_internal_account(posting, internal_accounts):
-    for pattern in internal_accounts:
-        if re.match(pattern, posting.account):
-            return True
-    return False
-
-def is_interesting_entry(entry, interesting_accounts):
-    """ Do any of the postings link to any of the accounts we care about? """
-    accounts = [p.account for p in entry.postings]
-    for posting in entry.postings:
-        if is_interesting_posting(posting, interesting_accounts):
-            return True
-    return False
-
-def iter_interesting_postings(date, entries, interesting_accounts):
+def get_balance_key(p):
+    """ Group a posting's units by currency and, if held at cost, the cost currency.
+
+    The cost currency is kept because it is the fallback conversion path, the same one that
+    beancount.core.convert.convert_position would use.
+    """
+    cost_currency = p.cost.currency if isinstance(p.cost, beancount.core.position.Cost) else None
+    return (p.units.currency, cost_currency)
+
+REGEX_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
+def compile_account_patterns(patterns):
+    """ Build a predicate that tells whether an account name matches any of 'patterns'.
+
+    Most patterns are plain account prefixes, which str.startswith can check all at once. Anything
+    that looks like a real regex is compiled on its own (so inline flags and backreferences keep
+    working) and tried only when none of the prefixes match. An empty list yields a predicate that
+    never matches.
+    """
+    prefixes = tuple(p for p in patterns if not REGEX_METACHARACTERS.intersection(p))
+    regexes = [re.compile(p) for p in patterns if REGEX_METACHARACTERS.intersection(p)]
+    if not regexes:
+        return lambda account: account.startswith(prefixes)
+    return lambda account: account.startswith(prefixes) or any(r.match(account) for r in regexes)
+
+# account classes returned by the classifier built in get_cashflows
+OTHER_ACCOUNT = 0
+INTERESTING_ACCOUNT = 1
+INTERNAL_ACCOUNT = 2
+
+@dataclasses.dataclass
+class PostingTable:
+    """ The postings of a chronological list of transactions, one parallel list per attribute.
+
+    The postings of transaction i are at offsets[i]:offsets[i+1].
+    """
+    entries: List[Transaction] = dataclasses.field(default_factory=list)
+    dates: List[datetime.date] = dataclasses.field(default_factory=list)
+    offsets: List[int] = dataclasses.field(default_factory=lambda: [0])
+    postings: List[Posting] = dataclasses.field(default_factory=list)
+    accounts: List[Account] = dataclasses.field(default_factory=list)
+    weights: List[Amount] = dataclasses.field(default_factory=list)
+    classes: List[int] = dataclasses.field(default_factory=list)
+
+def classify_entries(entries, classify):
+    """ Flatten the postings of 'entries' into a PostingTable, classifying each account once.
+
+    Entries that don't link to any of the accounts we care about are left out.
+    """
+    table = PostingTable()
     for e in entries:
-        if e.date <= date:
-            for p in e.postings:
-                if is_interesting_posting(p, interesting_accounts):
-                    yield p
-
-def get_inventory_as_of_date(date, entries, interesting_accounts):
-    inventory = beancount.core.inventory.Inventory()
-    for p in iter_interesting_postings(date, entries, interesting_accounts):
-        add_position(p, inventory)
-    return inventory
-
-def get_value_as_of(postings, date, currency, price_map, interesting_accounts):
-    inventory = get_inventory_as_of_date(date, postings, interesting_accounts)
-    balance = inventory.reduce(beancount.core.convert.convert_position, currency, price_map, date)
-    amount = balance.get_currency_units(currency)
-    return amount.number
+        classes = [classify(p.account) for p in e.postings]
+        if INTERESTING_ACCOUNT not in classes:
+            continue
+        table.entries.append(e)
+        table.dates.append(e.date)
+        table.postings.extend(e.postings)
+        table.accounts.extend(p.account for p in e.postings)
+        table.weights.extend(beancount.core.convert.get_weight(p) for p in e.postings)
+        table.classes.extend(classes)
+        table.offsets.append(len(table.postings))
+    return table
+
+def get_balances_as_of_dates(table, dates):
+    """ Snapshot the running balance at each of 'dates' in a single pass.
+
+    'dates' may be in any order; the balances come back in the same order. Each balance maps
+    get_balance_key() to the total number of units held.
+    """
+    balance = collections.defaultdict(Decimal)
+    balances = [None] * len(dates)
+    start = 0
+    # sweep the query dates in chronological order, remembering where each one came from
+    for i in sorted(range(len(dates)), key=lambda i: dates[i]):
+        # the table is sorted, so bisect for the last transaction on or before the date
+        end = bisect.bisect_right(table.dates, dates[i])
+        for j in range(table.offsets[start], table.offsets[end]):
+            if table.classes[j] == INTERESTING_ACCOUNT:
+                p = table.postings[j]
+                balance[get_balance_key(p)] += p.units.number
+        start = end
+        balances[i] = dict(balance)
+    return balances
+
+def get_values_as_of(table, dates, currency, price_map):
+    """ Market value in 'currency' of the interesting holdings at each of 'dates', in any order. """
+    values = []
+    for date, balance in zip(dates, get_balances_as_of_dates(table, dates)):
+        # one price lookup per currency held, rather than one per lot
+        value = 0.0
+        for (units_currency, cost_currency), number in balance.items():
+            if number == 0: continue
+            converted = beancount.core.convert.convert_amount(
+                Amount(number, units_currency), currency, price_map, date, via=(cost_currency,))
+            if converted.currency == currency:
+                value += float(converted.number)
+        values.append(value)
+    return values
 
 @dataclasses.dataclass
 class Cashflow:
     date: datetime.date
-    amount: Decimal
+    amount: float
     inflow_accounts: Set[Account] = dataclasses.field(default_factory=set)
     outflow_accounts: Set[Account] = dataclasses.field(default_factory=set)
     entry: Optional[Transaction] = None
 
 def get_cashflows(entries: List[Transaction], interesting_accounts: List[str], internal_accounts:
                   List[str], date_from: Optional[datetime.date], date_to: datetime.date,
-                  currency: Currency) -> List[Cashflow]:
+                  currency: Currency, track_flows: bool = True,
+                  price_map: Optional[beancount.core.prices.PriceMap] = None) -> List[Cashflow]:
     """Extract a series of cashflows affecting 'interesting_accounts'.
 
     A cashflow is represented by any transaction involving (1) an account in 'interesting_accounts'
@@ -88,20 +145,53 @@ def get_cashflows(entries: List[Transaction], interesting_accounts: List[str], i
     represent the market value of that balance as an inflow. The cashflows will be denominated in
     units of 'currency'.
 
+    If 'track_flows' is False, the inflow/outflow accounts of each cashflow are classified by the
+    sign of the posting's weight without converting it to 'currency', which skips a price lookup
+    for every external posting.
+
+    'price_map' is built from 'entries' if not given. Callers that compute several sets of
+    cashflows from the same ledger can build it once with beancount.core.prices.build_price_map
+    and pass it in.
+
     """
-    price_map = beancount.core.prices.build_price_map(entries)
-    only_txns = beancount.core.data.filter_txns(entries)
-    interesting_txns = [txn for txn in only_txns if is_interesting_entry(txn, interesting_accounts)]
-    # pull it into a list, instead of an iterator, because we're going to reuse it several times
-    interesting_txns = list(interesting_txns)
+    # compile the account patterns once up front rather than on every posting
+    is_interesting = compile_account_patterns(interesting_accounts)
+    is_internal = compile_account_patterns(internal_accounts)
+
+    # the same handful of account names show up over and over, so only match each one once
+    @functools.lru_cache(maxsize=None)
+    def classify(account: Account) -> int:
+        if is_interesting(account):
+            return INTERESTING_ACCOUNT
+        if is_internal(account):
+            return INTERNAL_ACCOUNT
+        return OTHER_ACCOUNT
+
+    if price_map is None:
+        price_map = beancount.core.prices.build_price_map(entries)
+
+    # postings in the same commodity on the same day share a rate, so look each one up only once
+    @functools.lru_cache(maxsize=None)
+    def get_rate(units_currency, date):
+        _, rate = beancount.core.prices.get_price(price_map, (units_currency, currency), date)
+        return rate
+
+    txns = sorted(beancount.core.data.filter_txns(entries), key=lambda txn: txn.date)
+    # filter and classify every posting in one pass; the main loop and both valuations below
+    # reuse the result
+    table = classify_entries(txns, classify)
+    accounts, weights, classes = table.accounts, table.weights, table.classes
+
+    # the transactions are sorted, so find the ones inside the date range by bisection
+    lo = bisect.bisect_left(table.dates, date_from) if date_from is not None else 0
+    hi = bisect.bisect_right(table.dates, date_to)
 
     cashflows = []
 
-    for entry in interesting_txns:
-        if date_from is not None and not date_from <= entry.date: continue
-        if not entry.date <= date_to: continue
+    for i in range(lo, hi):
+        date = table.dates[i]
 
-        cashflow = Decimal(0)
+        cashflow = 0.0
         inflow_accounts = set()
         outflow_accounts = set()
         # Imagine an entry that looks like
@@ -118,37 +208,45 @@ def get_cashflows(entries: List[Transaction], interesting_accounts: List[str], i
         # cashflows and subtract them out. This will leave a net $0
         # if all the cashflows are internal.
 
-        for posting in entry.postings:
-            converted = beancount.core.convert.convert_amount(
-                beancount.core.convert.get_weight(posting), currency, price_map, entry.date)
-            if converted.currency != currency:
-                logging.error(f'Could not convert posting {converted} from {entry.date} on line {posting.meta["lineno"]} to {currency}. IRR will be wrong.')
+        for j in range(table.offsets[i], table.offsets[i+1]):
+            cls = classes[j]
+            if cls == OTHER_ACCOUNT and not track_flows:
+                # only the sign matters here, so don't bother converting it
+                if weights[j].number > 0:
+                    outflow_accounts.add(accounts[j])
+                else:
+                    inflow_accounts.add(accounts[j])
+                continue
+            weight = weights[j]
+            rate = get_rate(weight.currency, date)
+            if rate is None:
+                logging.error(f'Could not convert posting {weight} from {date} on line {table.postings[j].meta["lineno"]} to {currency}. IRR will be wrong.')
                 continue
-            value = converted.number
+            value = float(weight.number * rate)
 
-            if is_interesting_posting(posting, interesting_accounts):
-                cashflow += value
-            elif is_internal_account(posting, internal_accounts):
+            if cls != OTHER_ACCOUNT:
                 cashflow += value
             else:
                 if value > 0:
-                    outflow_accounts.add(posting.account)
+                    outflow_accounts.add(accounts[j])
                 else:
-                    inflow_accounts.add(posting.account)
+                    inflow_accounts.add(accounts[j])
         # calculate net cashflow & the date
-        if cashflow.quantize(Decimal('.01')) != 0:
-            cashflows.append(Cashflow(date=entry.date, amount=cashflow,
+        if abs(cashflow) >= 0.005:
+            cashflows.append(Cashflow(date=date, amount=cashflow,
                                       inflow_accounts=inflow_accounts,
                                       outflow_accounts=outflow_accounts,
-                                      entry=entry))
+                                      entry=table.entries[i]))
 
+    # value the holdings at both ends of the period in one chronological sweep
     if date_from is not None:
-        start_value = get_value_as_of(interesting_txns, date_from + relativedelta(days=-1),
-                                      currency, price_map, interesting_accounts)
+        start_value, end_value = get_values_as_of(
+            table, [date_from + relativedelta(days=-1), date_to], currency, price_map)
         # if starting balance isn't $0 at starting time period then we need a cashflow
         if start_value != 0:
             cashflows.insert(0, Cashflow(date=date_from, amount=start_value))
-    end_value = get_value_as_of(interesting_txns, date_to, currency, price_map, interesting_accounts)
+    else:
+        end_value, = get_values_as_of(table, [date_to], currency, price_map)
     # if ending balance isn't $0 at end of time period then we need a cashflow
     if end_value != 0:
         cashflows.append(Cashflow(date=date_to, amount=-end_value))
@@ -2,26 +2,13 @@
 
 import logging
 import sys
-import itertools
-import functools
-import operator
-import math
 import collections
 import datetime
-import re
-from decimal import Decimal
+import numpy as np
 from dateutil.relativedelta import relativedelta
 from pprint import pprint
 from scipy import optimize
-from typing import Any, Dict, List, NamedTuple, Optional, Set, Union
 import beancount.loader
-import beancount.utils
-import beancount.core
-import beancount.core.getters
-import beancount.core.data
-import beancount.core.convert
-import beancount.parser
-from pprint import pprint
 from cashflows import get_cashflows
 
 # https://github.com/peliot/XIRR-and-XNPV/blob/master/financial.py
@@ -43,29 +30,166 @@ def xnpv(rate,cashflows):
     * This function is equivalent to the Microsoft Excel function of the same name. 
     """
 
-    chron_order = sorted(cashflows, key = lambda x: x[0])
+    years, amounts = cashflow_arrays(cashflows)
+    return (amounts * np.exp(-years * np.log1p(rate))).sum()
+
+def cashflow_arrays(cashflows):
+    """
+    Split a series of (date, amount) cashflows into two numpy arrays: the time in years since
+    the first cash flow, and the amounts. Cash flows on the same date are summed together, since
+    they share the same discount factor. Done once so the solver doesn't redo it every iteration.
+    """
+    by_date = collections.defaultdict(float)
+    for (t,cf) in cashflows:
+        by_date[t] += float(cf)
+    chron_order = sorted(by_date.items())
     t0 = chron_order[0][0] #t0 is the date of the first cash flow
+    years = np.array([(t-t0).days for (t,cf) in chron_order], dtype=np.float64) / 365.0
+    amounts = np.array([cf for (t,cf) in chron_order], dtype=np.float64)
+    return years, amounts
 
-    return sum([cf/(1+rate)**((t-t0).days/365.0) for (t,cf) in chron_order])
+def irr_newton(years, amounts, guess=0.1, tol=1e-8, maxiter=50):
+    """
+    Newton's method on the NPV as a plain numpy loop. For a few thousand cash flows this is cheaper
+    than going through scipy.optimize.root_scalar, which adds per-call bookkeeping.
+    Arguments
+    ---------
+    * years: numpy array of the time in years of each cash flow since the first one
+    * amounts: numpy array of the cash flow amounts
+    * guess, tol, maxiter: starting rate, convergence tolerance, and iteration limit. We stop once
+      the Newton step is within tol + tol*abs(r), the same rule scipy's newton uses with
+      xtol=rtol=tol.
+    """
+    r = guess
+    for _ in range(maxiter):
+        # (1+r)**-years, with the log taken once on the scalar rather than per element
+        discount = np.exp(-years * np.log1p(r))
+        f = (amounts * discount).sum()
+        fprime = -(years * amounts * discount).sum() / (1.0 + r)
+        step = f / fprime
+        converged = abs(step) <= tol + tol * abs(r)
+        r -= step
+        if converged:
+            return r
+    raise RuntimeError('Failed to converge')
 
-def xirr(cashflows,guess=0.1):
+def exnewton(f, x0, fprime, x1=None, tol=1e-8, maxiter=50):
+    """
+    Find a root of f with the extended Newton method: each step finds the root of the rational
+    function through f(x_n), f'(x_n) and the previous f(x_{n-1}), rather than of the tangent line.
+    That converges faster than Newton (order ~2.4) for the same evaluations, and copes better with
+    the sharply curved NPV you get from large late withdrawals.
+    Arguments
+    ---------
+    * f, fprime: the function and its derivative
+    * x0: the starting point
+    * x1 (optional): a second starting point, defaults to just beside x0
+    * tol, maxiter: convergence tolerance, and iteration limit. We stop once the step is within
+      tol + tol*abs(x), the same rule as irr_newton.
+    """
+    if x1 is None:
+        x1 = x0*(1+1e-4)+1e-4
+    x_prev, f_prev = x0, f(x0)
+    x = x1
+    for _ in range(maxiter):
+        fx = f(x)
+        fp = fprime(x)
+        dx = x - x_prev
+        secant = (fx - f_prev) / dx if dx != 0 else 0.0
+        if secant != 0:
+            denominator = fp + fx * (secant - fp) / (secant * dx)
+        else:
+            denominator = fp
+        if denominator == 0:
+            raise RuntimeError('Derivative was zero')
+        step = fx / denominator
+        converged = abs(step) <= tol + tol * abs(x)
+        x_prev, f_prev = x, fx
+        x -= step
+        if converged:
+            return x
+    raise RuntimeError('Failed to converge')
+
+def _newton(years, amounts, guess, use_scipy=False):
+    if not use_scipy:
+        return irr_newton(years, amounts, guess)
+
+    def f_and_fprime(r):
+        # the NPV and its derivative share the same discount factors, so compute them together
+        discount = np.exp(-years * np.log1p(r))
+        value = (amounts * discount).sum()
+        derivative = -(years * amounts * discount).sum() / (1.0 + r)
+        return value, derivative
+
+    solution = optimize.root_scalar(f_and_fprime, x0=guess, fprime=True, method='newton',
+                                  xtol=1e-8, rtol=1e-8)
+    if not solution.converged:
+        raise RuntimeError(f'Failed to converge: {solution.flag}')
+    return solution.root
+
+def _bracketed_root(years, amounts, guess):
+    """
+    Last resort when both Newton variants diverge from 'guess': scan a wide range of rates for a
+    sign change in the NPV, and polish the root in the bracket nearest 'guess' with brentq.
+    """
+    # rates from just above -100% up to 1e12, denser close to -100% and around zero
+    rates = np.concatenate([-1 + np.logspace(-6, 0, 60, endpoint=False), [0.0],
+                            np.logspace(-4, 12, 161)])
+    with np.errstate(over='ignore', under='ignore', invalid='ignore'):
+        values = (amounts * np.exp(-np.outer(np.log1p(rates), years))).sum(axis=1)
+    brackets = [i for i in range(len(rates) - 1)
+                if np.isfinite(values[i]) and np.isfinite(values[i+1])
+                and np.sign(values[i]) != np.sign(values[i+1])]
+    if not brackets:
+        raise RuntimeError('Failed to converge')
+    i = min(brackets, key=lambda i: max(rates[i] - guess, guess - rates[i+1], 0.0))
+    if values[i] == 0:
+        return rates[i]
+
+    def f(r):
+        return (amounts * np.exp(-years * np.log1p(r))).sum()
+
+    return optimize.brentq(f, rates[i], rates[i+1], xtol=1e-8, rtol=1e-8)
+
+def xirr(cashflows,guess=0.1,method='newton'):
     """
     Calculate the Internal Rate of Return of a series of cashflows at irregular intervals.
     Arguments
     ---------
     * cashflows: a list object in which each element is a tuple of the form (date, amount), where date is a python datetime.date object and amount is an integer or floating point number. Cash outflows (investments) are represented with negative amounts, and cash inflows (returns) are positive amounts.
     * guess (optional, default = 0.1): a guess at the solution to be used as a starting point for the numerical solution. 
+    * method (optional, default = 'newton'): 'newton', or 'exnewton' for the extended Newton method. If Newton's method fails to converge we retry with exnewton, and then with a bracketing search.
     Returns
     --------
     * Returns the IRR as a single value
     
     Notes
     ----------------
-    * The Internal Rate of Return (IRR) is the discount rate at which the Net Present Value (NPV) of a series of cash flows is equal to zero. The NPV of the series of cash flows is determined using the xnpv function in this module. The discount rate at which NPV equals zero is found using the secant method of numerical solution. 
+    * The Internal Rate of Return (IRR) is the discount rate at which the Net Present Value (NPV) of a series of cash flows is equal to zero. The NPV of the series of cash flows is determined using the xnpv function in this module. The discount rate at which NPV equals zero is found using Newton's method, with the analytic derivative of the NPV. 
     * This function is equivalent to the Microsoft Excel function of the same name.
-    * For users that do not have the scipy module installed, there is an alternate version (commented out) that uses the secant_method function defined in the module rather than the scipy.optimize module's numerical solver. Both use the same method of calculation so there should be no difference in performance, but the secant_method function does not fail gracefully in cases where there is no solution, so the scipy.optimize.newton version is preferred.
+    * With method='newton' the root is found by irr_newton, a plain numpy Newton loop. (_newton can also run the same iteration through scipy.optimize.root_scalar(method='newton'), given the NPV and its derivative together.) If that fails to converge, xirr retries with the extended Newton method (exnewton) from the same guess. method='exnewton' goes straight to exnewton. Both use the same stopping rule. Since a bad guess usually sinks both of them, the last resort scans a wide range of rates for a sign change in the NPV and finishes with scipy.optimize.brentq on the bracket nearest the guess (_bracketed_root). RuntimeError is raised only if no sign change is found.
     """
-    return optimize.newton(lambda r: xnpv(r,cashflows),guess)
+    years, amounts = cashflow_arrays(cashflows)
+
+    if method == 'newton':
+        try:
+            return _newton(years, amounts, guess)
+        except (RuntimeError, ZeroDivisionError):
+            logging.info("Newton's method failed to converge, retrying with extended Newton")
+    elif method != 'exnewton':
+        raise ValueError(f'Unknown method {method}')
+
+    def f(r):
+        return (amounts * np.exp(-years * np.log1p(r))).sum()
+
+    def fprime(r):
+        return -(years * amounts * np.exp(-years * np.log1p(r))).sum() / (1.0 + r)
+
+    try:
+        return exnewton(f, guess, fprime)
+    except (RuntimeError, ZeroDivisionError):
+        logging.info('Extended Newton failed to converge, falling back to a bracketing search')
+    return _bracketed_root(years, amounts, guess)
 
 def fmt_d(n):
     return '${:,.0f}'.format(n)
@@ -103,7 +227,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     shortcuts = ['year', 'ytd', '1year', '2year', '3year', '5year', '10year']
-    shortcut_used = functools.reduce(operator.__or__, [getattr(args, x) for x in shortcuts])
+    shortcut_used = any(getattr(args, x) for x in shortcuts)
     if shortcut_used and (args.date_from or args.date_to):
         raise(parser.error('Date shortcut options mutually exclusive with --to/--from options'))
 
@@ -148,11 +272,12 @@ if __name__ == '__main__':
 
     cashflows = get_cashflows(
         entries=entries, interesting_accounts=args.account, internal_accounts=args.internal,
-        date_from=args.date_from, date_to=args.date_to, currency=args.currency)
+        date_from=args.date_from, date_to=args.date_to, currency=args.currency,
+        track_flows=args.debug_inflows or args.debug_outflows)
 
     if cashflows:
-        # we need to coerce everything to a float for xirr to work...
-        r = xirr([(f.date, float(f.amount)) for f in cashflows])
+        # get_cashflows already hands back floats, so no Decimal reaches the solver
+        r = xirr([(f.date, f.amount) for f in cashflows])
         print(fmt_pct(r))
     else:
         logging.error(f'No cashflows found during the time period {args.date_from} -> {args.date_to}')
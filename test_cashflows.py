@@ -1,9 +1,9 @@
 import unittest
 import datetime
-from decimal import Decimal
 from typing import List
 
 from beancount import loader
+from beancount.core import prices
 from cashflows import Cashflow, get_cashflows
 
 
@@ -55,17 +55,17 @@ class TestCashflows(unittest.TestCase):
         expected_cashflows = [
             Cashflow(
                 date=datetime.date(2015, 12, 1),
-                amount=Decimal(1000),
+                amount=1000.0,
                 inflow_accounts=set(['Assets:Cash']),
             ),
             Cashflow(
                 date=datetime.date(2016, 12, 1),
-                amount=Decimal(2000),
+                amount=2000.0,
                 inflow_accounts=set(['Assets:Cash']),
             ),
             Cashflow(
                 date=datetime.date(2017, 12, 1),
-                amount=Decimal(-2500),
+                amount=-2500.0,
                 outflow_accounts=set(['Assets:Cash']),
             ),
         ]
@@ -74,6 +74,7 @@ class TestCashflows(unittest.TestCase):
             internal_accounts=['Income:CapitalGains'], date_from=datetime.date(2015, 12, 1),
             date_to=datetime.date(2017, 12, 1), currency='USD')
         self.assertEqual(expected_cashflows, simplify_cashflows(actual_cashflows))
+        self.assertTrue(all(isinstance(f.amount, float) for f in actual_cashflows))
 
         # Test 'date_from=None', which should be equivalent.
         actual_cashflows = get_cashflows(
@@ -82,6 +83,79 @@ class TestCashflows(unittest.TestCase):
             date_to=datetime.date(2017, 12, 1), currency='USD')
         self.assertEqual(expected_cashflows, simplify_cashflows(actual_cashflows))
 
+        # Classifying flows by the unconverted weight should give the same answer.
+        actual_cashflows = get_cashflows(
+            entries=entries, interesting_accounts=['Assets:Brokerage'],
+            internal_accounts=['Income:CapitalGains'], date_from=None,
+            date_to=datetime.date(2017, 12, 1), currency='USD', track_flows=False)
+        self.assertEqual(expected_cashflows, simplify_cashflows(actual_cashflows))
+
+        # A prebuilt price map gives the same answer.
+        actual_cashflows = get_cashflows(
+            entries=entries, interesting_accounts=['Assets:Brokerage'],
+            internal_accounts=['Income:CapitalGains'], date_from=None,
+            date_to=datetime.date(2017, 12, 1), currency='USD',
+            price_map=prices.build_price_map(entries))
+        self.assertEqual(expected_cashflows, simplify_cashflows(actual_cashflows))
+
+        # Patterns are regular expressions, inline flags included.
+        actual_cashflows = get_cashflows(
+            entries=entries, interesting_accounts=['(?i)assets:brokerage'],
+            internal_accounts=['Income:(Capital)?Gains'], date_from=None,
+            date_to=datetime.date(2017, 12, 1), currency='USD')
+        self.assertEqual(expected_cashflows, simplify_cashflows(actual_cashflows))
+
+    @loader.load_doc()
+    def test_mixed_patterns(self, entries, errors, options_map):
+        """
+        1792-01-01 commodity USD
+        2015-12-01 commodity ABC
+
+        2015-12-01 open Equity:Opening-Balances
+        2015-12-01 open Assets:Brokerage
+        2015-12-01 open Assets:Cash
+        2015-12-01 open Income:CapitalGains
+
+        2015-12-01 * "Opening balance"
+            Assets:Cash           3,000 USD
+            Equity:Opening-Balances
+
+        2015-12-01 price ABC 1.00 USD
+
+        2015-12-01 * "Buy 1,000 shares"
+            Assets:Brokerage      1,000 ABC {1.00 USD}
+            Assets:Cash          -1,000 USD
+
+        2017-12-01 price ABC 1.50 USD
+
+        2017-12-01 * "Sell 1,000 shares"
+            Assets:Brokerage     -1,000 ABC {1.00 USD}
+            Assets:Cash           1,500 USD
+            Income:CapitalGains    -500 USD
+        """
+        expected_cashflows = simplify_cashflows(get_cashflows(
+            entries=entries, interesting_accounts=['Assets:Brokerage', 'Assets:Cash'],
+            internal_accounts=['Income:CapitalGains'], date_from=None,
+            date_to=datetime.date(2017, 12, 1), currency='USD'))
+        self.assertEqual(expected_cashflows, [
+            Cashflow(
+                date=datetime.date(2015, 12, 1),
+                amount=3000.0,
+                inflow_accounts=set(['Equity:Opening-Balances']),
+            ),
+            Cashflow(
+                date=datetime.date(2017, 12, 1),
+                amount=-3500.0,
+            ),
+        ])
+
+        # Regexes and plain prefixes mixed in the same list take both matching paths.
+        actual_cashflows = get_cashflows(
+            entries=entries, interesting_accounts=['Assets:Broker.*', 'Assets:Cash'],
+            internal_accounts=['Income:Capital.*'], date_from=None,
+            date_to=datetime.date(2017, 12, 1), currency='USD')
+        self.assertEqual(expected_cashflows, simplify_cashflows(actual_cashflows))
+
     @loader.load_doc()
     def test_stock_conversion(self, entries, errors, options_map):
         """
@@ -107,12 +181,12 @@ class TestCashflows(unittest.TestCase):
         expected_cashflows = [
             Cashflow(
                 date=datetime.date(2018, 1, 1),
-                amount=Decimal(100),
+                amount=100.0,
                 inflow_accounts=set(['Assets:Cash']),
             ),
             Cashflow(
                 date=datetime.date(2018, 12, 31),
-                amount=Decimal(-150),
+                amount=-150.0,
             ),
         ]
         actual_cashflows = get_cashflows(
@@ -164,17 +238,17 @@ class TestCashflows(unittest.TestCase):
         expected_cashflows = [
             Cashflow(
                 date=datetime.date(2015, 12, 1),
-                amount=Decimal('1000.00'),
+                amount=1000.0,
                 inflow_accounts=set(['Assets:Cash']),
             ),
             Cashflow(
                 date=datetime.date(2016, 12, 1),
-                amount=Decimal('2000.00'),
+                amount=2000.0,
                 inflow_accounts=set(['Assets:Cash']),
             ),
             Cashflow(
                 date=datetime.date(2018, 12, 1),
-                amount=Decimal('-3550.00'),
+                amount=-3550.0,
                 outflow_accounts=set(['Assets:Cash']),
             ),
         ]
@@ -185,3 +259,47 @@ class TestCashflows(unittest.TestCase):
             currency='USD')
         self.maxDiff = None
         self.assertEqual(expected_cashflows, simplify_cashflows(actual_cashflows))
+
+    @loader.load_doc()
+    def test_opening_balance(self, entries, errors, options_map):
+        """
+        1792-01-01 commodity USD
+        2015-12-01 commodity ABC
+
+        2015-12-01 open Assets:Brokerage
+        2015-12-01 open Assets:Cash
+
+        2015-12-01 price ABC 1.00 USD
+
+        2015-12-01 * "Buy 1,000 shares"
+            Assets:Brokerage      1,000 ABC {1.00 USD}
+            Assets:Cash
+
+        2016-12-01 price ABC 2.00 USD
+
+        2016-12-01 * "Buy 1,000 more shares"
+            Assets:Brokerage      1,000 ABC {2.00 USD}
+            Assets:Cash
+
+        2017-12-01 price ABC 1.50 USD
+        """
+        expected_cashflows = [
+            Cashflow(
+                date=datetime.date(2016, 6, 1),
+                amount=1000.0,
+            ),
+            Cashflow(
+                date=datetime.date(2016, 12, 1),
+                amount=2000.0,
+                inflow_accounts=set(['Assets:Cash']),
+            ),
+            Cashflow(
+                date=datetime.date(2017, 12, 1),
+                amount=-3000.0,
+            ),
+        ]
+        actual_cashflows = get_cashflows(
+            entries=entries, interesting_accounts=['Assets:Brokerage'], internal_accounts=[],
+            date_from=datetime.date(2016, 6, 1), date_to=datetime.date(2017, 12, 1),
+            currency='USD')
+        self.assertEqual(expected_cashflows, simplify_cashflows(actual_cashflows))
@@ -0,0 +1,65 @@
+import unittest
+import datetime
+import os
+
+from beancount import loader
+
+import irr
+from cashflows import get_cashflows
+
+
+class TestXirr(unittest.TestCase):
+
+    def example_cashflows(self):
+        entries, errors, options_map = loader.load_file(
+            os.path.join(os.path.dirname(__file__), 'example.bean'))
+        cashflows = get_cashflows(
+            entries=entries, interesting_accounts=['Assets:Brokerage'], internal_accounts=['Income'],
+            date_from=None, date_to=datetime.date(2017, 12, 31), currency='USD')
+        return [(f.date, f.amount) for f in cashflows]
+
+    def test_example(self):
+        # xirr is -0.129094555 according to Excel, see example.bean
+        self.assertAlmostEqual(irr.xirr(self.example_cashflows()), -0.129094555, places=8)
+
+    def test_exnewton(self):
+        cashflows = self.example_cashflows()
+        self.assertAlmostEqual(irr.xirr(cashflows, method='exnewton'), irr.xirr(cashflows),
+                               places=10)
+
+    def test_fallback_to_exnewton(self):
+        cashflows = [(datetime.date(2020, 1, 1), -100), (datetime.date(2021, 1, 1), 10)]
+        years, amounts = irr.cashflow_arrays(cashflows)
+        with self.assertRaises(RuntimeError):
+            irr.irr_newton(years, amounts)
+        self.assertAlmostEqual(irr.xirr(cashflows), -0.8994, places=4)
+
+    def test_fallback_to_bracketing(self):
+        # Newton and extended Newton both diverge from the default guess on this series
+        cashflows = [
+            (datetime.date(2010, 1, 1), 101.31), (datetime.date(2010, 3, 10), -802.87),
+            (datetime.date(2010, 10, 27), 906.12), (datetime.date(2010, 12, 22), -301.33),
+            (datetime.date(2013, 2, 16), -769.83), (datetime.date(2015, 4, 24), 309.42),
+            (datetime.date(2015, 5, 3), -177.4), (datetime.date(2016, 12, 5), 162.43),
+            (datetime.date(2017, 3, 20), -169.8), (datetime.date(2017, 9, 13), -29.87),
+            (datetime.date(2018, 3, 21), 122.89),
+        ]
+        years, amounts = irr.cashflow_arrays(cashflows)
+        with self.assertRaises(RuntimeError):
+            irr._newton(years, amounts, 0.1)
+        r = irr.xirr(cashflows)
+        self.assertAlmostEqual(r, -0.29394074, places=6)
+        self.assertAlmostEqual(irr.xnpv(r, cashflows), 0.0, places=6)
+        self.assertAlmostEqual(irr.xirr(cashflows, method='exnewton'), r, places=8)
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            irr.xirr(self.example_cashflows(), method='bisect')
+
+    def test_irr_newton_and_scipy_agree(self):
+        # a 100x return in a month: the rate is huge, so only a relative stopping rule converges
+        cashflows = [(datetime.date(2020, 1, 1), -100), (datetime.date(2020, 2, 1), 10000)]
+        years, amounts = irr.cashflow_arrays(cashflows)
+        scipy_rate = irr._newton(years, amounts, 0.1, use_scipy=True)
+        self.assertAlmostEqual(3.5349811050301046e+23 / scipy_rate, 1.0, places=6)
+        self.assertAlmostEqual(irr.irr_newton(years, amounts) / scipy_rate, 1.0, places=6)